@@ -2,9 +2,11 @@
 import argparse
 import csv
 import datetime
+import heapq
 import io
 import itertools
 import json
+import math
 import numpy
 import pygal
 import time
@@ -14,6 +16,7 @@ import sys
 from collections import defaultdict, deque, Counter, namedtuple
 from ciso8601 import parse_datetime
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from cheroot.wsgi import Server, PathInfoDispatcher
 from jinja2 import Template
 from urllib.request import urlopen
@@ -25,18 +28,141 @@ _BlockSummary = namedtuple(
     ['timestamp', 'producer', 'slot_position', 'produced', 'action_counts']
 )
 
+# Rough per-item costs, used for memory accounting. These don't need to be
+# exact - they just need to be cheap to compute and roughly proportional.
+_POINTER_BYTES = 8
+_STAT_ENTRY_BYTES = (
+    sys.getsizeof((None, None))
+    + sys.getsizeof(datetime.datetime(1970, 1, 1))
+    + sys.getsizeof(1000)
+    + _POINTER_BYTES
+)
+_SERIES_BYTES = sys.getsizeof(deque()) + sys.getsizeof('producer') + 2 * _POINTER_BYTES
+_SUMMARY_BYTES = (
+    sys.getsizeof(_BlockSummary(None, None, None, None, None))
+    + sys.getsizeof(datetime.datetime(1970, 1, 1))
+    + sys.getsizeof(Counter())
+    + _POINTER_BYTES
+)
+_COUNTER_ENTRY_BYTES = sys.getsizeof('eosio.token:transfer') + sys.getsizeof(1000) + 3 * _POINTER_BYTES
+_HEAP_ENTRY_BYTES = sys.getsizeof((1000, None)) + sys.getsizeof(1000) + 2 * _POINTER_BYTES
+
+
+class _TopKCounter:
+    # Space-Saving sketch of the k most common keys. Once full, a new key
+    # replaces the current minimum and inherits its count, so counts can
+    # overestimate by at most that minimum, but any key seen more than N/k
+    # times is guaranteed to be kept, even if it only gets busy later on.
+    def __init__(self, k):
+        if k < 1:
+            raise ValueError(f"Top-K counter needs k of at least 1, not {k}")
+        self._k = k
+        self._counts = {}
+        # Lazy min-heap of (count, key) - entries go stale as counts grow, and
+        # get skipped when popped, or dropped when the heap is rebuilt
+        self._heap = []
+
+    def add(self, key, count=1):
+        if key in self._counts:
+            self._counts[key] += count
+        elif len(self._counts) < self._k:
+            self._counts[key] = count
+        else:
+            min_key, min_count = self._pop_min()
+            del self._counts[min_key]
+            self._counts[key] = min_count + count
+        heapq.heappush(self._heap, (self._counts[key], key))
+        if len(self._heap) > 4 * self._k:
+            self._heap = [(c, k) for k, c in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        # Counts only ever increase, so an entry is current iff its count matches
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self._counts.get(key) == count:
+                return key, count
+
+    def most_common(self, n=None):
+        return Counter(self._counts).most_common(n)
+
+    def __getitem__(self, key):
+        return self._counts.get(key, 0)
+
+    def __len__(self):
+        return len(self._counts)
+
+    @property
+    def memory_usage(self):
+        return (
+            sys.getsizeof(self._counts) + len(self._counts) * _COUNTER_ENTRY_BYTES
+            + len(self._heap) * _HEAP_ENTRY_BYTES
+        )
+
+    @property
+    def max_memory_usage(self):
+        return (
+            sys.getsizeof(dict.fromkeys(range(self._k))) + self._k * _COUNTER_ENTRY_BYTES
+            + (4 * self._k + 1) * _HEAP_ENTRY_BYTES
+        )
+
+
+class _StageTimings:
+    # Thread-safe running totals of wall-clock time spent in each named stage
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = defaultdict(lambda: [0, 0.0, 0.0])  # count, total, max
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                timing = self._timings[stage]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: tuple(timing) for stage, timing in sorted(self._timings.items())}
+
+
+def _summary_size(summary):
+    return _SUMMARY_BYTES + len(summary.action_counts) * _COUNTER_ENTRY_BYTES
+
+
 class BPPerformance:
-    def __init__(self, classifiers, endpoint="http://localhost:8888", max_count=300, max_age=3*86400):
+    def __init__(self, classifiers, endpoint="http://localhost:8888", max_count=300, max_age=3*86400,
+                 max_memory=None, unknown_top_k=1000):
+        if max_count < 1:
+            raise ValueError(f"max_count must be at least 1, not {max_count}")
+        if max_age <= 0:
+            raise ValueError(f"max_age must be positive, not {max_age}")
         self._endpoint = endpoint
         self._classifiers = classifiers
         self._max_count = max_count
         self._max_age = max_age
+        self._max_memory = max_memory
+        self._last_budget_warning = None
         self._stopped = True
         self._stats = defaultdict(lambda: defaultdict(deque))
         self._block_summaries = deque()
+        self._block_summaries_bytes = 0
         self._last_timestamp = datetime.datetime(1970, 1, 1)
         self._schedules = {}
-        self.unknown = Counter()
+        self.unknown = _TopKCounter(unknown_top_k)
+        self.timings = _StageTimings()
+        # The unknown action counter is bounded by its size, not shed, so leave room for it
+        self._unknown_reserve = self.unknown.max_memory_usage
+        if max_memory is not None and max_memory <= self._unknown_reserve:
+            raise ValueError(
+                f"Memory budget of {max_memory} bytes must exceed the "
+                f"{self._unknown_reserve} bytes reserved for unknown action counts"
+            )
 
     def watch(self):
         self._stopped = False
@@ -71,7 +197,7 @@ class BPPerformance:
                 for bp, timings in sorted(bps.items())
                 if self._trim_stats(timings, self._last_timestamp)
             }
-            for category, bps in self._stats.items()
+            for category, bps in list(self._stats.items())
         }
 
     @property
@@ -104,6 +230,15 @@ class BPPerformance:
             } for producer, action_types in action_counts.items()
         }
 
+    @property
+    def memory_usage(self):
+        # Approximate bytes used by each in-memory structure
+        series = [queue for bps in list(self._stats.values()) for queue in list(bps.values())]
+        return {
+            'stats': sum(_SERIES_BYTES + len(queue) * _STAT_ENTRY_BYTES for queue in series),
+            'block_summaries': self._block_summaries_bytes,
+            'unknown': self.unknown.memory_usage
+        }
 
     def _handle_block_transactions(self, block):
         timestamp = parse_datetime(block['timestamp'])
@@ -122,7 +257,7 @@ class BPPerformance:
                         if category:
                             self._store_value(producer, category, timestamp, cpu)
                     else:
-                        self.unknown[f"{action['account']}:{action['name']}"] += 1
+                        self.unknown.add(f"{action['account']}:{action['name']}")
 
     def _handle_block_summaries(self, block):
         timestamp = parse_datetime(block['timestamp'])
@@ -137,7 +272,7 @@ class BPPerformance:
                     missed_timestamp = last_timestamp + (i + 1) * datetime.timedelta(seconds=0.5)
                     producer, slot_position = _block_producer_for_timestamp(missed_timestamp, schedule)
                     missed_block_summary = _BlockSummary(missed_timestamp, producer, slot_position, False, Counter())
-                    self._block_summaries.append(missed_block_summary)
+                    self._append_block_summary(missed_block_summary)
         if block['new_producers']:
             self._load_schedule(block['new_producers'])
         schedule = self._schedules.get(block['schedule_version'])
@@ -151,9 +286,17 @@ class BPPerformance:
                     for action in actions:
                         action_counts[f"{action['account']}:{action['name']}"] += 1
             block_summary = _BlockSummary(timestamp, block['producer'], slot_position, True, action_counts)
-            self._block_summaries.append(block_summary)
+            self._append_block_summary(block_summary)
         while len(self._block_summaries) > self._max_age * 2:
-            self._block_summaries.popleft()
+            self._pop_block_summary()
+
+    def _append_block_summary(self, block_summary):
+        self._block_summaries.append(block_summary)
+        self._block_summaries_bytes += _summary_size(block_summary)
+
+    def _pop_block_summary(self):
+        block_summary = self._block_summaries.popleft()
+        self._block_summaries_bytes -= _summary_size(block_summary)
 
 
     def _find_producer_schedules(self):
@@ -179,10 +322,65 @@ class BPPerformance:
         self._schedules[version] = [producer['producer_name'] for producer in schedule['producers']]
 
     def _handle_block(self, block):
-        self._handle_block_transactions(block)
-        self._handle_block_summaries(block)
+        with self.timings.span('handle_block_transactions'):
+            self._handle_block_transactions(block)
+        with self.timings.span('handle_block_summaries'):
+            self._handle_block_summaries(block)
         timestamp = parse_datetime(block['timestamp'])
         self._last_timestamp = timestamp
+        if self._max_memory is not None:
+            with self.timings.span('enforce_memory_budget'):
+                self._enforce_memory_budget()
+
+    def _enforce_memory_budget(self):
+        # Only stats and block summaries get shed - the unknown counter has its
+        # worst case reserved out of the budget up front
+        budget = self._max_memory - self._unknown_reserve
+        usage = self.memory_usage
+        if usage['stats'] + usage['block_summaries'] <= budget:
+            return
+        # Near the budget this runs on most blocks, so only warn once a minute
+        now = time.monotonic()
+        if self._last_budget_warning is None or now - self._last_budget_warning > 60:
+            self._last_budget_warning = now
+            print(
+                f"Over memory budget ({usage['stats'] + usage['block_summaries']} > {budget} bytes, "
+                f"after reserving for unknown actions): {usage}",
+                file=sys.stderr
+            )
+        while usage['stats'] + usage['block_summaries'] > budget:
+            # Shed data from whichever structure is currently biggest, falling
+            # back to the other one once it has nothing left to give
+            if usage['stats'] >= usage['block_summaries']:
+                shed = self._downsample_largest_series() or self._evict_oldest_block_summaries()
+            else:
+                shed = self._evict_oldest_block_summaries() or self._downsample_largest_series()
+            if not shed:
+                break
+            usage = self.memory_usage
+
+    def _evict_oldest_block_summaries(self):
+        if not self._block_summaries:
+            return False
+        # Evict the oldest tenth at a time, so we're not recounting after every block
+        for _ in range(max(1, len(self._block_summaries) // 10)):
+            self._pop_block_summary()
+        return True
+
+    def _downsample_largest_series(self):
+        # Halve the largest series by discarding every other sample, which
+        # preserves the distribution across the time window. The web threads
+        # read these concurrently, so swap in a new deque rather than
+        # mutating in place, and never remove keys.
+        largest_size, largest_bps, largest_bp = 0, None, None
+        for bps in list(self._stats.values()):
+            for bp, queue in list(bps.items()):
+                if len(queue) > largest_size:
+                    largest_size, largest_bps, largest_bp = len(queue), bps, bp
+        if largest_bps is None:
+            return False
+        largest_bps[largest_bp] = deque(list(largest_bps[largest_bp])[1::2])
+        return True
 
     def _store_value(self, producer, category, timestamp, time):
         queue = self._stats[category][producer]
@@ -210,14 +408,15 @@ class BPPerformance:
         return info['last_irreversible_block_num']
 
     def _get_block(self, block):
-        return json.loads(
-            urlopen(
+        with self.timings.span('get_block'):
+            body = urlopen(
                 f"{self._endpoint}/v1/chain/get_block",
                 json.dumps({
                     "block_num_or_id": str(block)
                 }).encode('utf-8')
-            ).read().decode('utf-8', errors='replace')
-        )
+            ).read()
+        with self.timings.span('decode_block'):
+            return json.loads(body.decode('utf-8', errors='replace'))
 
 def _timestamp_to_slot(timestamp):
     epoch_time = timestamp - datetime.datetime.fromtimestamp(946684800)
@@ -588,6 +787,94 @@ classifiers = {
 }
 
 
+def timed(bp_perf, stage):
+    def wrapper(f):
+        def wrapped(environ, start_response):
+            with bp_perf.timings.span(stage):
+                # Handlers build their whole response up front, so this covers rendering
+                return f(environ, start_response)
+        return wrapped
+    return wrapper
+
+def stage_timings_csv(bp_perf):
+    def render_csv(environ, start_response):
+        output_file = io.StringIO()
+        writer = csv.DictWriter(
+            output_file, ["Stage", "Count", "Total Seconds", "Mean Seconds", "Max Seconds"]
+        )
+        writer.writeheader()
+        for stage, (count, total, maximum) in bp_perf.timings.snapshot().items():
+            writer.writerow({
+                "Stage": stage,
+                "Count": count,
+                "Total Seconds": total,
+                "Mean Seconds": total / count,
+                "Max Seconds": maximum
+            })
+        start_response('200 OK', [('Content-Type', 'text/csv; charset=utf-8')])
+        return [output_file.getvalue().encode('utf-8')]
+    return render_csv
+
+def memory_usage_csv(bp_perf):
+    def render_csv(environ, start_response):
+        output_file = io.StringIO()
+        writer = csv.DictWriter(output_file, ["Structure", "Bytes"])
+        writer.writeheader()
+        for structure, size in bp_perf.memory_usage.items():
+            writer.writerow({"Structure": structure, "Bytes": size})
+        start_response('200 OK', [('Content-Type', 'text/csv; charset=utf-8')])
+        return [output_file.getvalue().encode('utf-8')]
+    return render_csv
+
+def _collapse_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})".replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+def _sample_stacks(seconds, interval):
+    # Poor man's sampling profiler: periodically snapshot every thread's stack
+    samples = Counter()
+    own_thread = threading.get_ident()
+    thread_names = {}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread in threading.enumerate():
+            thread_names[thread.ident] = thread.name
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_thread:
+                thread_name = thread_names.get(thread_id, str(thread_id)).replace(';', ':')
+                samples[f"{thread_name};{_collapse_stack(frame)}"] += 1
+        time.sleep(interval)
+    return samples
+
+def profile(max_seconds=60, interval=0.01):
+    profile_lock = threading.Lock()
+    def render_profile(environ, start_response):
+        req = Request(environ)
+        try:
+            seconds = float(req.args.get('seconds', 10))
+        except ValueError:
+            seconds = math.nan
+        if not (math.isfinite(seconds) and seconds > 0):
+            start_response('400 Bad Request', [('content-type', 'text/plain; charset=ascii')])
+            return [b"seconds must be a positive number"]
+        seconds = min(seconds, max_seconds)
+        if not profile_lock.acquire(blocking=False):
+            start_response('409 Conflict', [('content-type', 'text/plain; charset=ascii')])
+            return [b"A profile is already running"]
+        try:
+            samples = _sample_stacks(seconds, interval)
+        finally:
+            profile_lock.release()
+        # Collapsed stack format, as consumed by flamegraph.pl and speedscope
+        result = ''.join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        start_response('200 OK', [('content-type', 'text/plain; charset=utf-8')])
+        return [result.encode('utf-8')]
+    return render_profile
+
 def cache_middleware(expiry_seconds):
     expiry = datetime.timedelta(seconds=expiry_seconds)
     cache = {}
@@ -649,25 +936,66 @@ if __name__ == '__main__':
     parser.add_argument('--port', nargs='?', default=8953, type=int)
     parser.add_argument('--certificate', nargs='?', help='TLS cert location')
     parser.add_argument('--key', nargs='?', help='TLS private key location')
+    parser.add_argument('--max-count', nargs='?', default=300, type=int,
+                        help='Maximum samples kept per transaction type and producer')
+    parser.add_argument('--max-age', nargs='?', default=3*86400, type=int,
+                        help='Maximum age of retained data, in seconds')
+    parser.add_argument('--max-memory', nargs='?', type=float,
+                        help='Approximate memory budget for retained data, in MiB')
+    parser.add_argument('--unknown-top-k', nargs='?', default=1000, type=int,
+                        help='Number of unclassified action types to keep counts for')
+    parser.add_argument('--enable-admin', action='store_true',
+                        help='Serve stage timings (/timings.csv), memory usage (/memory.csv) and an '
+                             'on-demand profiler (/profile?seconds=N) on a separate admin listener. '
+                             'These have no access control, tie up a worker while profiling, and '
+                             'expose source paths and thread names, so keep them off public interfaces')
+    parser.add_argument('--admin-host', nargs='?', default='127.0.0.1')
+    parser.add_argument('--admin-port', nargs='?', default=8954, type=int)
     args = parser.parse_args()
-    bp_perf = BPPerformance(classifiers, endpoint=args.nodeos_url)
+    if args.unknown_top_k < 1:
+        parser.error("--unknown-top-k must be at least 1")
+    try:
+        bp_perf = BPPerformance(
+            classifiers,
+            endpoint=args.nodeos_url,
+            max_count=args.max_count,
+            max_age=args.max_age,
+            max_memory=int(args.max_memory * 1024 * 1024) if args.max_memory is not None else None,
+            unknown_top_k=args.unknown_top_k
+        )
+    except ValueError as e:
+        parser.error(str(e))
     thread = threading.Thread(target=bp_perf.watch)
     thread.start()
 
     app = cache_middleware(60)(
         PathInfoDispatcher({
-            '/': index(bp_perf),
-            '/chart': transaction_chart(bp_perf),
-            '/transactions.csv': transaction_csv(bp_perf),
-            '/missed_slots': missed_slots(bp_perf),
-            '/missed_slots_by_time': missed_slots_by_time(bp_perf),
-            '/missed_slots.csv': missed_slots_csv(bp_perf),
-            '/transactions_per_block': transactions_per_block(bp_perf)
+            '/': timed(bp_perf, 'wsgi:/')(index(bp_perf)),
+            '/chart': timed(bp_perf, 'wsgi:/chart')(transaction_chart(bp_perf)),
+            '/transactions.csv': timed(bp_perf, 'wsgi:/transactions.csv')(transaction_csv(bp_perf)),
+            '/missed_slots': timed(bp_perf, 'wsgi:/missed_slots')(missed_slots(bp_perf)),
+            '/missed_slots_by_time': timed(bp_perf, 'wsgi:/missed_slots_by_time')(missed_slots_by_time(bp_perf)),
+            '/missed_slots.csv': timed(bp_perf, 'wsgi:/missed_slots.csv')(missed_slots_csv(bp_perf)),
+            '/transactions_per_block': timed(bp_perf, 'wsgi:/transactions_per_block')(transactions_per_block(bp_perf))
         })
     )
 
     httpd = Server((args.host, args.port), app)
 
+    admin_httpd = None
+    if args.enable_admin:
+        # Admin endpoints get their own listener, loopback-only by default, and
+        # bypass the cache - they should always be live
+        admin_httpd = Server((args.admin_host, args.admin_port), PathInfoDispatcher({
+            '/timings.csv': stage_timings_csv(bp_perf),
+            '/memory.csv': memory_usage_csv(bp_perf),
+            '/profile': profile()
+        }))
+        # Bind here rather than in the thread, so a bad host or busy port is fatal
+        admin_httpd.prepare()
+        print(f"Serving admin endpoints on {args.admin_host}:{args.admin_port}")
+        threading.Thread(target=admin_httpd.serve, daemon=True).start()
+
     if args.certificate:
         from cheroot.ssl.builtin import BuiltinSSLAdapter
         httpd.ssl_adapter = BuiltinSSLAdapter(args.certificate, args.key)
@@ -676,4 +1004,6 @@ if __name__ == '__main__':
         print(f"Serving on {args.host}:{args.port}")
         httpd.safe_start()
     finally:
+        if admin_httpd:
+            admin_httpd.stop()
         bp_perf.stop()